@@ -2,56 +2,204 @@
 # SPDX-License-Identifier: AGPL-3.0-or-later
 
 import asyncio
+import hashlib
 import json
+import os
 import re
 import sys
-from itertools import groupby
+import tempfile
+import time
+from functools import lru_cache
 from urllib.parse import urlparse
 
 import aiohttp
 import click
+import orjson
 import toml
 from packaging import version
 
 parallelism = 100
 github_base = "https://api.github.com/repos"
+github_graphql_base = "https://api.github.com/graphql"
+github_graphql_chunk = 50
 gitlab_base = "https://gitlab.com"
 arch_base = "https://www.archlinux.org/packages/search/json"
 aur_base = "https://aur.archlinux.org/rpc"
+aur_chunk = 150
 
 asession = None
-tag_match = re.compile(r"^[0-9a-fA-F]+\s+refs/tags/([^/^]+)(\^\{\})?$")
+tag_match = re.compile(rb"^[0-9a-fA-F]+\s+refs/tags/([^/^\n]+)(?:\^\{\})?$", re.M)
 
-fetch_sem = asyncio.Semaphore(value=parallelism)
+cache_base = os.path.join(os.path.expanduser("~"), ".cache", "johnny")
+cache_expire = 900
+use_cache = True
 
 
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def cache_path(url):
+    return os.path.join(cache_base, hashlib.sha256(url.encode("UTF-8")).hexdigest())
+
+
+def cache_load(url, max_age=cache_expire):
+    try:
+        path = cache_path(url)
+        if max_age is not None and time.time() - os.path.getmtime(path) > max_age:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cache_write(path, body):
+    # Temp file + atomic rename: a run killed mid-write can never leave
+    # a truncated entry behind
+    fd, tmp = tempfile.mkstemp(dir=cache_base)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(body)
+        os.replace(tmp, path)
+    except OSError:
+        os.unlink(tmp)
+        raise
+
+
+def cache_store(url, body, etag=None, last_modified=None):
+    try:
+        os.makedirs(cache_base, exist_ok=True)
+        path = cache_path(url)
+        if etag:
+            cache_write(path + ".etag", etag.encode("UTF-8"))
+        if last_modified:
+            cache_write(path + ".lm", last_modified.encode("UTF-8"))
+        # The body goes last so a 304 can never revalidate a body that
+        # was not fully stored
+        cache_write(path, body)
+    except OSError:
+        pass
+
+
+def cache_validator(url, suffix):
+    try:
+        with open(cache_path(url) + suffix, "r", encoding="UTF-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def cache_refresh(url):
+    try:
+        os.utime(cache_path(url))
+    except OSError:
+        pass
+
+
+simple_version = frozenset("0123456789.")
+version_match = re.compile(
+    r"^\s*" + version.VERSION_PATTERN + r"\s*$", re.VERBOSE | re.IGNORECASE
+)
+
+
+@lru_cache(maxsize=8192)
+def parse_one(ver):
+    ver = ver.strip("v")
+    if (
+        ver
+        and simple_version.issuperset(ver)
+        and ".." not in ver
+        and ver[0] != "."
+        and ver[-1] != "."
+    ):
+        # Digit-only versions skip the PEP 440 regex entirely
+        return version.Version(ver)
+    # Reject nightly-*, date tags etc. with one C-level regex pass
+    # instead of letting version.parse build a LegacyVersion first
+    if version_match.match(ver) is None:
+        return None
+    ver = version.parse(ver)
+    return version.parse(ver.base_version)
+
+
 def try_parse_versions(versions):
-    res = []
-    for ver in versions:
-        ver = ver.strip("v")
-        ver = version.parse(ver)
-        if not isinstance(ver, version.LegacyVersion):
-            ver = version.parse(ver.base_version)
-            res.append(ver)
-    return sorted(res)
+    return sorted(filter(None, map(parse_one, versions)))
 
 
-async def fetch(name, url, headers=None):
-    async with fetch_sem:
-        r = await asession.get(url, headers=headers)
-        r = await r.text()
-    return (name, r)
+def try_max_version(versions):
+    best = None
+    for ver in versions:
+        parsed = parse_one(ver)
+        if parsed is not None and (best is None or parsed > best):
+            best = parsed
+    return best
 
 
-def git_get_version(line):
-    m = tag_match.match(line)
-    if m:
-        return m.group(1)
-    return None
+async def fetch(name, url, headers=None):
+    # Returns raw bytes: orjson parses them directly and we skip
+    # aiohttp's charset detection and str decode entirely.
+    stale = None
+    if use_cache:
+        body = cache_load(url)
+        if body is not None:
+            return (name, body)
+        # Expired entries with an ETag can be revalidated for free: a 304
+        # carries no body and does not count against GitHub's rate limit.
+        stale = cache_load(url, max_age=None)
+        if stale is not None:
+            etag = cache_validator(url, ".etag")
+            last_modified = cache_validator(url, ".lm")
+            if etag or last_modified:
+                headers = dict(headers) if headers else {}
+                if etag:
+                    headers["If-None-Match"] = etag
+                if last_modified:
+                    headers["If-Modified-Since"] = last_modified
+            else:
+                stale = None
+    r = await asession.get(url, headers=headers)
+    if stale is not None and r.status == 304:
+        # Release so the connection goes back to the pool for keep-alive
+        r.release()
+        cache_refresh(url)
+        return (name, stale)
+    if r.status != 200:
+        # Error bodies (404s, rate-limit 403s) are not worth parsing
+        r.release()
+        return (name, None)
+    body = await r.read()
+    if use_cache:
+        cache_store(url, body, r.headers.get("ETag"), r.headers.get("Last-Modified"))
+    return (name, body)
+
+
+async def fetch_post(name, url, data, headers=None):
+    key = f"{url}\n{data}"
+    if use_cache:
+        body = cache_load(key)
+        if body is not None:
+            return (name, body)
+    r = await asession.post(url, data=data, headers=headers)
+    if r.status != 200:
+        r.release()
+        return (name, None)
+    body = await r.read()
+    if use_cache:
+        cache_store(key, body)
+    return (name, body)
+
+
+async def fetch_json_all(aws):
+    # Shared fan-in for the JSON sources: gather the fetches and yield
+    # (name, parsed body), skipping failed or empty responses
+    for result in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(result, Exception):
+            continue
+        name, r = result
+        if r is None:
+            continue
+        yield name, orjson.loads(r)
 
 
 async def git(args, pkgs):
@@ -66,17 +214,17 @@ async def git(args, pkgs):
                 aws.append(fetch(name, f"{base}/info/refs?service=git-upload-pack"))
     if not aws:
         return {}
-    done, _ = await asyncio.wait(aws)
-    for t in done:
-        vers = set()
-        name, r = t.result()
-        for line in r.splitlines():
-            tag = git_get_version(line)
-            if tag:
-                vers.add(tag)
-        vers = try_parse_versions(vers)
-        if vers:
-            res[name] = vers[-1]
+    for result in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(result, Exception):
+            continue
+        name, r = result
+        if r is None:
+            continue
+        best = try_max_version(
+            m.group(1).decode("UTF-8", "replace") for m in tag_match.finditer(r)
+        )
+        if best is not None:
+            res[name] = best
     return res
     # TODO reenable call to git
     # out = check_output(["git", "ls-remote", "--tags", base]).decode("UTF-8")
@@ -86,28 +234,26 @@ async def gitlab(args, pkgs, type="releases", field="tag_name"):
     res = {}
     aws = []
     arg_gitlab_token = args["gitlab_token"]
+    token_headers = None
+    if arg_gitlab_token:
+        token_headers = {"Private-Token": arg_gitlab_token}
     for name, pkg in pkgs.items():
         id_ = pkg.get("gitlab")
         if id_:
             id_ = id_.replace("/", "%2F")
             base = pkg.get("url", gitlab_base)
-            headers = {}
-            if arg_gitlab_token and base == github_base:
-                headers = {"Private-Token": f"token {arg_gitlab_token}"}
+            # Only send the token to gitlab.com, not self-hosted bases
+            headers = token_headers if base == gitlab_base else None
             aws.append(
                 fetch(name, f"{base}/api/v4/projects/{id_}/{type}", headers=headers)
             )
     if not aws:
         return {}
-    done, _ = await asyncio.wait(aws)
-    for t in done:
-        name, r = t.result()
-        j = json.loads(r)
+    async for name, j in fetch_json_all(aws):
         if j:
-            vers = [x[field] for x in j if field in x]
-            vers = try_parse_versions(vers)
-            if vers:
-                res[name] = vers[-1]
+            best = try_max_version(x[field] for x in j if field in x)
+            if best is not None:
+                res[name] = best
     return res
 
 
@@ -115,28 +261,78 @@ async def gitlab_tags(args, pkgs):
     return await gitlab(args, pkgs, "repository/tags", "name")
 
 
+async def github_graphql(pkgs, token, type="releases"):
+    # Aliased queries resolve many repositories per round-trip and cost
+    # one rate-limit point each instead of one per repository. Chunked
+    # to stay below GitHub's per-query node limits.
+    res = {}
+    if type == "releases":
+        sub = "{ releases(last: 20) { nodes { tagName } } }"
+        field = "tagName"
+    else:
+        sub = '{ refs(refPrefix: "refs/tags/", last: 100) { nodes { name } } }'
+        field = "name"
+    headers = {"Authorization": f"bearer {token}"}
+    aliases = {}
+    items = list(pkgs.items())
+    aws = []
+    for start in range(0, len(items), github_graphql_chunk):
+        parts = []
+        chunk = items[start : start + github_graphql_chunk]
+        for i, (name, pkg) in enumerate(chunk, start):
+            owner, _, repo = pkg["github"].partition("/")
+            alias = f"r{i}"
+            aliases[alias] = name
+            parts.append(f'{alias}: repository(owner: "{owner}", name: "{repo}") {sub}')
+        query = "query { " + " ".join(parts) + " }"
+        aws.append(
+            fetch_post(
+                "github",
+                github_graphql_base,
+                json.dumps({"query": query}),
+                headers=headers,
+            )
+        )
+    async for _, j in fetch_json_all(aws):
+        data = j.get("data") or {}
+        for alias, repo in data.items():
+            name = aliases.get(alias)
+            if name is None or not repo:
+                continue
+            nodes = (repo.get("releases") or repo.get("refs") or {}).get("nodes", [])
+            best = try_max_version(x[field] for x in nodes if x.get(field))
+            if best is not None:
+                res[name] = best
+    return res
+
+
 async def github(args, pkgs, type="releases", field="tag_name"):
     res = {}
     aws = []
     arg_github_token = args["github_token"]
+    pkgs = {k: v for k, v in pkgs.items() if v.get("github")}
+    if arg_github_token and type in ("releases", "tags") and pkgs:
+        res = await github_graphql(pkgs, arg_github_token, type)
+        pkgs = {k: v for k, v in pkgs.items() if k not in res}
+    if type == "releases":
+        # One release object instead of the full paginated history
+        type = "releases/latest"
+    headers = None
+    if arg_github_token:
+        headers = {"Authorization": f"token {arg_github_token}"}
     for name, pkg in pkgs.items():
-        id_ = pkg.get("github")
-        if id_:
-            headers = None
-            if arg_github_token:
-                headers = {"Authorization": f"token {arg_github_token}"}
-            aws.append(fetch(name, f"{github_base}/{id_}/{type}", headers=headers))
+        id_ = pkg["github"]
+        aws.append(fetch(name, f"{github_base}/{id_}/{type}", headers=headers))
     if not aws:
-        return {}
-    done, _ = await asyncio.wait(aws)
-    for t in done:
-        name, r = t.result()
-        j = json.loads(r)
+        return res
+    async for name, j in fetch_json_all(aws):
+        if isinstance(j, dict):
+            # releases/latest returns a single object (or an error dict)
+            j = [j]
         if j:
-            vers = [x[field] for x in j if field in x]
-            vers = try_parse_versions(vers)
-            if vers:
-                res[name] = vers[-1]
+            best = try_max_version(x[field] for x in j if field in x)
+            if best is not None:
+                res[name] = best
     return res
 
 
@@ -149,37 +345,41 @@ async def arch(args, pkgs):
     aws = []
     for name, pkg in pkgs.items():
         id_ = pkg.get("arch", name)
-        r = aws.append(fetch(name, f"{arch_base}/?name={id_}"))
+        aws.append(fetch(name, f"{arch_base}/?name={id_}"))
     if not aws:
         return {}
-    done, _ = await asyncio.wait(aws)
-    for t in done:
-        name, r = t.result()
-        j = json.loads(r)
+    async for name, j in fetch_json_all(aws):
         j = j["results"]
         if j:
-            vers = try_parse_versions([j[0]["pkgver"]])
-            if vers:
-                res[name] = vers[0]
+            best = parse_one(j[0]["pkgver"])
+            if best is not None:
+                res[name] = best
     return res
 
 
 async def aur(args, pkgs):
-    query = []
-    items = list(pkgs.items())
-    for name, pkg in items:
-        id_ = pkg.get("aur", name)
-        query.append(f"arg[]={id_}")
-    query = "&".join(query)
-    _, r = await fetch("aur", f"{aur_base}/?v=5&type=info&{query}")
-    j = json.loads(r)
-    j = j["results"]
     res = {}
-    for i, v in enumerate(j):
-        if v:
-            vers = try_parse_versions([v["Version"]])
-            if vers:
-                res[items[i][0]] = vers[0]
+    name_by_aur = {}
+    for name, pkg in pkgs.items():
+        name_by_aur[pkg.get("aur", name)] = name
+    ids = list(name_by_aur)
+    aws = []
+    # Chunk the query to stay below AUR's URL-length limit
+    for i in range(0, len(ids), aur_chunk):
+        query = "&".join(f"arg[]={id_}" for id_ in ids[i : i + aur_chunk])
+        aws.append(fetch("aur", f"{aur_base}/?v=5&type=info&{query}"))
+    if not aws:
+        return res
+    async for _, j in fetch_json_all(aws):
+        # Key by the returned Name: AUR does not guarantee that results
+        # come back in query order
+        for v in j["results"]:
+            name = name_by_aur.get(v.get("Name"))
+            if name is None:
+                continue
+            best = parse_one(v["Version"])
+            if best is not None:
+                res[name] = best
     return res
 
 
@@ -190,20 +390,25 @@ sources["gitlab_tags"] = gitlab_tags
 sources["git"] = git
 
 
-def update(old, new):
-    res = dict(old)
-    for k, v in new.items():
-        if k not in res:
-            res[k] = v
-        else:
-            ov = res[k]
-            if v > ov:
-                res[k] = v
+_query_cache = {}
+
+
+async def cached_query(name, args, pkgs):
+    # A source asked twice for the same package set (e.g. as primary and
+    # again as secondary fallback) is answered from the per-run memo.
+    key = (name, frozenset(pkgs))
+    res = _query_cache.get(key)
+    if res is None:
+        res = await sources[name](args, pkgs)
+        _query_cache[key] = res
     return res
 
 
-def make_serializable(s):
-    return {k: str(v) for k, v in s.items()}
+def update(old, new):
+    for k, v in new.items():
+        ov = old.get(k)
+        if ov is None or v > ov:
+            old[k] = v
 
 
 def status(args, source, query, new, all):
@@ -223,82 +428,97 @@ def status(args, source, query, new, all):
         )
 
 
-async def do_get_primary(s, args, x, k):
-    return (args, x, k, await s(args, x))
+async def do_get_primary(args, x, k):
+    return (args, x, k, await cached_query(k, args, x))
+
+
+def group_primary(c):
+    groups = {}
+    for k, v in c.items():
+        p = v.get("primary")
+        if p:
+            groups.setdefault(p, {})[k] = v
+    return groups
 
 
-async def get_primary(args, c, vers):
-    primary = [(k, v) for k, v in c.items() if "primary" in v]
-    primary = sorted(primary, key=lambda i: i[1]["primary"])
-    primary = groupby(primary, key=lambda i: i[1]["primary"])
-    vers = dict(vers)
+async def get_primary(args, primary_groups, vers):
     asked = set()
     aws = []
-    for k, g in primary:
-        g = list(g)
-        x = dict(g)
+    for k, g in primary_groups.items():
+        x = {n: p for n, p in g.items() if n not in vers}
         asked.add(k)
-        s = sources[k]
-        aws.append(do_get_primary(s, args, x, k))
+        if not x:
+            continue
+        aws.append(do_get_primary(args, x, k))
     if not aws:
-        return vers, asked
-    done, _ = await asyncio.wait(aws)
-    for t in done:
-        args, x, k, new = t.result()
-        vers = update(vers, new)
+        return asked
+    for result in await asyncio.gather(*aws, return_exceptions=True):
+        if isinstance(result, Exception):
+            continue
+        args, x, k, new = result
+        update(vers, new)
         status(args, k, x, new, len(vers))
     if not args["quiet"]:
         eprint("primary done")
-    return vers, asked
+    return asked
 
 
 async def get_secondary_source(args, c, s, vers, left):
-    new = await s(args, left)
-    vers = update(vers, new)
+    new = await cached_query(s.__name__, args, left)
+    update(vers, new)
     status(args, s.__name__, left, new, len(vers))
     arg_trust_secondary = args["trust_secondary"]
     if arg_trust_secondary:
-        return vers, {k: v for k, v in c.items() if k not in vers}
-    return vers, left
+        # Prune resolved packages instead of rebuilding left from c
+        for k in vers.keys() & left.keys():
+            del left[k]
+    return left
 
 
 async def run_secondary(args, c, vers, asked, left, l):
     if left:
         for s in [x for x in sources_list if l(x.__name__, asked)]:
-            vers, left = await get_secondary_source(args, c, s, vers, left)
+            left = await get_secondary_source(args, c, s, vers, left)
             if not left:
                 break
-    return vers, left
+    return left
 
 
 async def get_secondary(args, c, vers, asked, left):
-    vers = dict(vers)
     # Do not ask the sources we just asked (a slight optimization)
-    vers, left = await run_secondary(
+    left = await run_secondary(
         args, c, vers, asked, left, lambda name, asked: name not in asked
     )
-    vers, left = await run_secondary(
+    if not left:
+        return left
+    left = await run_secondary(
         args, c, vers, asked, left, lambda name, asked: name in asked
     )
-    return vers, left
+    return left
 
 
-async def get_vers(args, c):
+async def get_vers(args, c, primary_groups):
     global asession
-    async with aiohttp.ClientSession() as asession:
+    global use_cache
+    use_cache = args["cache"]
+    _query_cache.clear()
+    connector = aiohttp.TCPConnector(
+        limit=parallelism, limit_per_host=parallelism // 4, ttl_dns_cache=300
+    )
+    async with aiohttp.ClientSession(connector=connector) as asession:
         arg_primary = args["primary"]
         arg_secondary = args["secondary"]
         arg_trust_primary = args["trust_primary"]
         vers = {}
         asked = set()
         if arg_primary:
-            vers, asked = await get_primary(args, c, vers)
+            asked = await get_primary(args, primary_groups, vers)
         if arg_trust_primary:
             left = {k: v for k, v in c.items() if k not in vers}
         else:
             left = dict(c)
         if arg_secondary and left:
-            vers, left = await get_secondary(args, c, vers, asked, left)
+            left = await get_secondary(args, c, vers, asked, left)
         left = ", ".join([k for k in left.keys()])
         if left:
             eprint(f"Packages left: {left}")
@@ -330,18 +550,17 @@ defaults = {
     "trust_secondary": True,
     "print_names": False,
     "quiet": False,
+    "cache": True,
 }
 
 
 def read_config(args, config):
-    args = dict(args)
-    for k in config.keys():
-        if k not in args:
-            raise KeyError(k, "Unknown config option")
-    for k, v in args.items():
-        if v is None:
-            args[k] = config.get(k, defaults.get(k))
-    return args
+    unknown = config.keys() - args.keys()
+    if unknown:
+        raise KeyError(next(iter(unknown)), "Unknown config option")
+    supplied = {k: v for k, v in args.items() if v is not None}
+    # Precedence: command line > config file > defaults > None
+    return {**dict.fromkeys(args), **defaults, **config, **supplied}
 
 
 @click.command(
@@ -377,19 +596,21 @@ def read_config(args, config):
 @click.option(
     "--quiet/--no-quiet", default=None, help="do not print anything to stderr",
 )
+@click.option(
+    "--cache/--no-cache", default=None, help="cache API responses on disk",
+)
 def cli(config, **kwargs):
     c = toml.load(config)
     jc = c.get("johnny_config", {})
     kwargs = read_config(kwargs, jc)
     if jc:
         del c["johnny_config"]
-    loop = asyncio.get_event_loop()
-    vers, left = loop.run_until_complete(get_vers(kwargs, c))
+    primary_groups = group_primary(c)
+    vers, left = asyncio.run(get_vers(kwargs, c, primary_groups))
     if kwargs["filter"]:
         vers = filter_vers(vers, c)
-        print(json.dumps(vers))
-    else:
-        print(json.dumps(make_serializable((vers))))
+    # default=str renders the Version objects; no intermediate dict needed
+    sys.stdout.buffer.write(orjson.dumps(vers, default=str) + b"\n")
     if left:
         sys.exit(1)
 
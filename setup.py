@@ -16,11 +16,11 @@ DESCRIPTION = "generic dep(p)endencies tracker"
 URL = "https://github.com/adfinis-sygroup/johnny"
 EMAIL = "jean-louis.fuchs@adfinis-sygroup.ch"
 AUTHOR = "Jean-Louis Fuchs"
-REQUIRES_PYTHON = ">=3.6.0"
+REQUIRES_PYTHON = ">=3.7.0"
 VERSION = "0.2.1"
 
 # What packages are required for this module to be executed?
-REQUIRED = ["toml", "click", "requests", "aiohttp", "aiodns"]
+REQUIRED = ["toml", "click", "aiohttp", "aiodns", "orjson"]
 
 # What packages are optional?
 EXTRAS = {
@@ -113,7 +113,6 @@ setup(
         "Topic :: Software Development",
         "Programming Language :: Python",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
     ],